@@ -1,15 +1,68 @@
+import asyncio
+import hmac
+import logging
 import os
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Header, Query
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Optional, Tuple
+import orjson
+from typing_extensions import Annotated, NotRequired, TypedDict
+from fastapi import FastAPI, HTTPException, Header, Query, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import ConnectionFailure
 from datetime import datetime
 
-from database import db, create_document, get_documents
-from schemas import Product as ProductSchema
+from database import db, create_document
 
-app = FastAPI(title="Retail App API", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+# --------- Startup ---------
+
+_INDEXES = [
+    # Backs the newest-first sort in list_orders when no status filter is given
+    ("order", [("placed_at", -1)]),
+    # Backs list_orders filtered by status, still sorted newest-first
+    ("order", [("status", 1), ("placed_at", -1)]),
+    # Backs the q search in list_products
+    ("product", [("title", "text"), ("description", "text"), ("category", "text")]),
+    # Backs the in_stock/category filter in list_products, and newest-first product scans
+    ("product", [("in_stock", 1), ("category", 1)]),
+    ("product", [("created_at", -1)]),
+]
+
+
+async def ensure_indexes():
+    if db is None:
+        return
+    # Index creation is best-effort: an unreachable database or a conflicting
+    # existing index must not stop the API from starting (/test reports DB errors)
+    for collection, keys in _INDEXES:
+        try:
+            await db[collection].create_index(keys)
+        except ConnectionFailure:
+            logger.exception("Database unreachable; skipping index creation")
+            return
+        except Exception:
+            logger.exception("Could not create index %s on %s", keys, collection)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build indexes in the background so requests are served while the driver
+    # waits out server selection against a slow or unreachable database
+    task = asyncio.create_task(ensure_indexes())
+    yield
+    task.cancel()
+
+
+app = FastAPI(title="Retail App API", version="1.0.0", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,33 +74,58 @@ app.add_middleware(
 
 # --------- Helpers ---------
 
+_OID_RE = re.compile(r"[0-9a-fA-F]{24}").fullmatch
+
+
 def to_object_id(id_str: str) -> ObjectId:
-    try:
-        return ObjectId(id_str)
-    except Exception:
+    if not _OID_RE(id_str):
         raise HTTPException(status_code=400, detail="Invalid ID format")
+    return ObjectId(id_str)
 
 
 def serialize_doc(doc: dict):
     if not doc:
         return None
     doc["id"] = str(doc.pop("_id"))
-    # Convert datetimes to isoformat
-    for k in ["created_at", "updated_at", "placed_at"]:
-        if k in doc and isinstance(doc[k], datetime):
-            doc[k] = doc[k].isoformat()
     return doc
 
 
+async def collect_docs(cursor) -> List[dict]:
+    """Drain a cursor in one pass, renaming _id to id as documents arrive"""
+    docs = []
+    async for doc in cursor:
+        doc["id"] = str(doc.pop("_id"))
+        docs.append(doc)
+    return docs
+
+
+def json_list_response(docs: List[dict]) -> Response:
+    """Encode a list of docs in a single orjson pass; datetimes are handled natively"""
+    return Response(orjson.dumps(docs), media_type="application/json")
+
+
+_ADMIN_KEY = os.getenv("ADMIN_KEY", "admin123").encode()
+
+
 def require_admin(admin_key: Optional[str]):
-    expected = os.getenv("ADMIN_KEY", "admin123")
-    if admin_key != expected:
+    if not admin_key or not hmac.compare_digest(admin_key.encode(), _ADMIN_KEY):
         raise HTTPException(status_code=401, detail="Unauthorized: invalid admin key")
 
 
 # --------- Schemas ---------
 
+# Request bodies are read-only once validated: no revalidation, copies or assignment checks
+REQUEST_MODEL_CONFIG = ConfigDict(
+    extra="ignore",
+    revalidate_instances="never",
+    frozen=True,
+    str_strip_whitespace=False,
+    validate_assignment=False,
+)
+
 class ProductCreate(BaseModel):
+    model_config = REQUEST_MODEL_CONFIG
+
     title: str
     description: Optional[str] = None
     price: float = Field(..., ge=0)
@@ -57,6 +135,8 @@ class ProductCreate(BaseModel):
     in_stock: bool = True
 
 class ProductUpdate(BaseModel):
+    model_config = REQUEST_MODEL_CONFIG
+
     title: Optional[str] = None
     description: Optional[str] = None
     price: Optional[float] = Field(None, ge=0)
@@ -65,36 +145,96 @@ class ProductUpdate(BaseModel):
     image_url: Optional[str] = None
     in_stock: Optional[bool] = None
 
-class CartItem(BaseModel):
+# Response shape for product listings; keys outside it are dropped on serialization
+
+class ProductOut(TypedDict):
+    id: str
+    title: str
+    description: NotRequired[Optional[str]]
+    price: float
+    currency: NotRequired[str]
+    category: str
+    in_stock: NotRequired[bool]
+    image_url: NotRequired[Optional[str]]
+    created_at: NotRequired[datetime]
+    updated_at: NotRequired[datetime]
+
+_PRODUCT_ADAPTER = TypeAdapter(List[ProductOut])
+
+# Order payloads are plain dicts validated by a single module-level TypeAdapter
+
+class CartItem(TypedDict):
     product_id: str
     title: str
     price: float
-    quantity: int = Field(..., ge=1)
+    quantity: Annotated[int, Field(ge=1)]
 
-class CustomerInfo(BaseModel):
+class CustomerInfo(TypedDict):
     name: str
     phone: str
     city: str
     address: str
-    notes: Optional[str] = None
+    notes: NotRequired[Optional[str]]
 
-class OrderCreate(BaseModel):
+class OrderCreate(TypedDict):
     items: List[CartItem]
     customer: CustomerInfo
-    payment_method: str = Field("COD", description="Cash on delivery only")
+    # Omitted means "COD"; the default is documented only, create_order applies it
+    payment_method: NotRequired[
+        Annotated[str, Field(description="Cash on delivery only", json_schema_extra={"default": "COD"})]
+    ]
+
+ORDER_ADAPTER = TypeAdapter(OrderCreate)
+
+# create_order reads the raw body, so its OpenAPI request body is declared by hand.
+# The order schemas are published under components/schemas like FastAPI's own models.
+_ORDER_SCHEMA = ORDER_ADAPTER.json_schema(ref_template="#/components/schemas/{model}")
+_ORDER_COMPONENTS = {**_ORDER_SCHEMA.pop("$defs", {}), "OrderCreate": _ORDER_SCHEMA}
+ORDER_OPENAPI_EXTRA = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {"$ref": "#/components/schemas/OrderCreate"}}},
+    }
+}
+
+_base_openapi = app.openapi
+
+
+def openapi():
+    if app.openapi_schema is None:
+        schema = _base_openapi()
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(_ORDER_COMPONENTS)
+    return app.openapi_schema
+
+
+app.openapi = openapi
 
 class OrderStatusUpdate(BaseModel):
+    model_config = REQUEST_MODEL_CONFIG
+
     status: str = Field(..., description="new | confirmed | on_the_way | delivered | cancelled")
     tracking_note: Optional[str] = None
 
+# --------- Projections ---------
+
+# Only the fields the API returns are fetched and BSON-decoded
+_PRODUCT_PROJECTION = {
+    "title": 1, "description": 1, "price": 1, "currency": 1, "category": 1,
+    "in_stock": 1, "image_url": 1, "created_at": 1, "updated_at": 1,
+}
+_ORDER_PROJECTION = {
+    "items": 1, "customer": 1, "payment_method": 1, "status": 1, "tracking_note": 1,
+    "total": 1, "currency": 1, "placed_at": 1, "created_at": 1, "updated_at": 1,
+}
+
 # --------- Basic Routes ---------
 
 @app.get("/")
-def root():
+async def root():
     return {"message": "Retail API شغال", "cod": True}
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -109,7 +249,7 @@ def test_database():
             response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
             response["database_name"] = db.name
             response["connection_status"] = "Connected"
-            response["collections"] = db.list_collection_names()
+            response["collections"] = await db.list_collection_names()
             response["database"] = "✅ Connected & Working"
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:80]}"
@@ -117,122 +257,192 @@ def test_database():
 
 # --------- Products ---------
 
+# In-process LRU cache for get_product: str(ObjectId) -> (expires_at, serialized doc).
+# Per-worker only; writes below invalidate their own worker's entry.
+PRODUCT_CACHE_TTL = 30.0
+PRODUCT_CACHE_MAX_ENTRIES = 1024
+_product_cache: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+# Bumped on every invalidation so a read that raced a write doesn't re-cache stale data
+_product_cache_generation = 0
+
+
+def _product_cache_get(key: str) -> Optional[dict]:
+    entry = _product_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del _product_cache[key]
+        return None
+    _product_cache.move_to_end(key)
+    return entry[1]
+
+
+def _product_cache_put(key: str, doc: dict):
+    _product_cache[key] = (time.monotonic() + PRODUCT_CACHE_TTL, doc)
+    _product_cache.move_to_end(key)
+    while len(_product_cache) > PRODUCT_CACHE_MAX_ENTRIES:
+        _product_cache.popitem(last=False)
+
+
+def _product_cache_invalidate(key: str):
+    global _product_cache_generation
+    _product_cache_generation += 1
+    _product_cache.pop(key, None)
+
+# Queries shorter than this are too short for word-based text search; use a prefix match instead
+MIN_TEXT_SEARCH_LEN = 3
+
 @app.get("/api/products")
-def list_products(q: Optional[str] = Query(None, description="search query"), category: Optional[str] = None):
-    filt = {"in_stock": {"$ne": False}}
-    if q:
+async def list_products(q: Optional[str] = Query(None, description="search query"), category: Optional[str] = None):
+    filt = {"in_stock": True}
+    if q and len(q) >= MIN_TEXT_SEARCH_LEN:
+        filt["$text"] = {"$search": q}
+    elif q:
+        prefix = "^" + re.escape(q)
         filt["$or"] = [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"description": {"$regex": q, "$options": "i"}},
-            {"category": {"$regex": q, "$options": "i"}},
+            {"title": {"$regex": prefix, "$options": "i"}},
+            {"description": {"$regex": prefix, "$options": "i"}},
+            {"category": {"$regex": prefix, "$options": "i"}},
         ]
     if category:
         filt["category"] = category
-    docs = get_documents("product", filt, limit=None)
-    return [serialize_doc(d) for d in docs]
+    docs = await collect_docs(db["product"].find(filt, _PRODUCT_PROJECTION))
+    return Response(_PRODUCT_ADAPTER.dump_json(docs), media_type="application/json")
 
 @app.get("/api/products/{product_id}")
-def get_product(product_id: str):
-    doc = db["product"].find_one({"_id": to_object_id(product_id)})
+async def get_product(product_id: str):
+    oid = to_object_id(product_id)
+    key = str(oid)
+    cached = _product_cache_get(key)
+    if cached is not None:
+        return cached
+    generation = _product_cache_generation
+    doc = await db["product"].find_one({"_id": oid}, _PRODUCT_PROJECTION)
     if not doc:
         raise HTTPException(status_code=404, detail="Product not found")
-    return serialize_doc(doc)
+    doc = serialize_doc(doc)
+    if generation == _product_cache_generation:
+        _product_cache_put(key, doc)
+    return doc
 
 @app.post("/api/products")
-def create_product(payload: ProductCreate, x_admin_key: Optional[str] = Header(None)):
+async def create_product(payload: ProductCreate, x_admin_key: Optional[str] = Header(None)):
     require_admin(x_admin_key)
-    # Validate with ProductSchema then insert
-    product = ProductSchema(
-        title=payload.title,
-        description=payload.description,
-        price=payload.price,
-        category=payload.category,
-        in_stock=payload.in_stock,
-    ).model_dump()
+    # payload is already validated by ProductCreate; build the ProductSchema-shaped dict directly
+    product = {
+        "title": payload.title,
+        "description": payload.description,
+        "price": payload.price,
+        "category": payload.category,
+        "in_stock": payload.in_stock,
+        "image_url": payload.image_url,
+    }
     # extra fields
-    if payload.image_url:
-        product["image_url"] = payload.image_url
     product["currency"] = payload.currency
-    inserted_id = create_document("product", product)
-    doc = db["product"].find_one({"_id": ObjectId(inserted_id)})
+    doc = await create_document("product", product, return_document=True)
     return serialize_doc(doc)
 
 @app.patch("/api/products/{product_id}")
-def update_product(product_id: str, payload: ProductUpdate, x_admin_key: Optional[str] = Header(None)):
+async def update_product(product_id: str, payload: ProductUpdate, x_admin_key: Optional[str] = Header(None)):
     require_admin(x_admin_key)
-    updates = {k: v for k, v in payload.model_dump(exclude_none=True).items()}
+    updates = payload.model_dump(exclude_unset=True, exclude_none=True)
     if not updates:
         return {"updated": False}
     updates["updated_at"] = datetime.utcnow()
-    res = db["product"].update_one({"_id": to_object_id(product_id)}, {"$set": updates})
-    if res.matched_count == 0:
+    oid = to_object_id(product_id)
+    doc = await db["product"].find_one_and_update(
+        {"_id": oid},
+        {"$set": updates},
+        projection=_PRODUCT_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    doc = db["product"].find_one({"_id": to_object_id(product_id)})
+    _product_cache_invalidate(str(oid))
     return serialize_doc(doc)
 
 @app.delete("/api/products/{product_id}")
-def delete_product(product_id: str, x_admin_key: Optional[str] = Header(None)):
+async def delete_product(product_id: str, x_admin_key: Optional[str] = Header(None)):
     require_admin(x_admin_key)
-    res = db["product"].delete_one({"_id": to_object_id(product_id)})
+    oid = to_object_id(product_id)
+    res = await db["product"].delete_one({"_id": oid})
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    _product_cache_invalidate(str(oid))
     return {"deleted": True}
 
 # --------- Orders (COD) ---------
 
-@app.post("/api/orders")
-def create_order(payload: OrderCreate):
-    if payload.payment_method != "COD":
+@app.post("/api/orders", openapi_extra=ORDER_OPENAPI_EXTRA)
+async def create_order(request: Request):
+    # Parse and validate the raw body in one pass with pydantic-core's JSON parser
+    try:
+        data = ORDER_ADAPTER.validate_json(await request.body())
+    except ValidationError as e:
+        # Match FastAPI's own body errors, whose loc starts with "body"
+        errors = [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        raise RequestValidationError(errors) from e
+    if data.get("payment_method", "COD") != "COD":
         raise HTTPException(status_code=400, detail="Only COD is supported")
-    if len(payload.items) == 0:
+    items = data["items"]
+    if len(items) == 0:
         raise HTTPException(status_code=400, detail="Cart is empty")
 
-    total = sum(i.price * i.quantity for i in payload.items)
+    customer = data["customer"]
+    customer.setdefault("notes", None)
+    total = sum(i["price"] * i["quantity"] for i in items)
     order = {
-        "items": [i.model_dump() for i in payload.items],
-        "customer": payload.customer.model_dump(),
+        "items": items,
+        "customer": customer,
         "payment_method": "COD",
         "status": "new",
         "total": total,
         "currency": "SYP",
         "placed_at": datetime.utcnow(),
     }
-    inserted_id = create_document("order", order)
-    doc = db["order"].find_one({"_id": ObjectId(inserted_id)})
+    doc = await create_document("order", order, return_document=True)
     return serialize_doc(doc)
 
 @app.get("/api/orders")
-def list_orders(x_admin_key: Optional[str] = Header(None), status: Optional[str] = None):
+async def list_orders(
+    x_admin_key: Optional[str] = Header(None),
+    status: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500, description="page size"),
+    skip: int = Query(0, ge=0),
+):
     require_admin(x_admin_key)
     filt = {}
     if status:
         filt["status"] = status
-    docs = get_documents("order", filt)
-    docs.sort(key=lambda d: d.get("placed_at", datetime.utcnow()), reverse=True)
-    return [serialize_doc(d) for d in docs]
+    docs = await collect_docs(db["order"].find(filt, _ORDER_PROJECTION).sort("placed_at", -1).skip(skip).limit(limit))
+    return json_list_response(docs)
 
 @app.get("/api/orders/{order_id}")
-def get_order(order_id: str, x_admin_key: Optional[str] = Header(None)):
+async def get_order(order_id: str, x_admin_key: Optional[str] = Header(None)):
     require_admin(x_admin_key)
-    doc = db["order"].find_one({"_id": to_object_id(order_id)})
+    doc = await db["order"].find_one({"_id": to_object_id(order_id)}, _ORDER_PROJECTION)
     if not doc:
         raise HTTPException(status_code=404, detail="Order not found")
     return serialize_doc(doc)
 
 @app.patch("/api/orders/{order_id}")
-def update_order(order_id: str, payload: OrderStatusUpdate, x_admin_key: Optional[str] = Header(None)):
+async def update_order(order_id: str, payload: OrderStatusUpdate, x_admin_key: Optional[str] = Header(None)):
     require_admin(x_admin_key)
-    updates = payload.model_dump(exclude_none=True)
+    updates = payload.model_dump(exclude_unset=True, exclude_none=True)
     updates["updated_at"] = datetime.utcnow()
-    res = db["order"].update_one({"_id": to_object_id(order_id)}, {"$set": updates})
-    if res.matched_count == 0:
+    doc = await db["order"].find_one_and_update(
+        {"_id": to_object_id(order_id)},
+        {"$set": updates},
+        projection=_ORDER_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
         raise HTTPException(status_code=404, detail="Order not found")
-    doc = db["order"].find_one({"_id": to_object_id(order_id)})
     return serialize_doc(doc)
 
 # Health
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True}
 
 